@@ -23,19 +23,32 @@
 
 import argparse
 import atexit
+import collections
+import concurrent.futures
 import configparser
 import datetime
+import functools
 import io
+import json
 import logging
+import multiprocessing
 import os
 import re
 import shutil
+import stat
 import sys
 import time
 
+import imagesize
+import PIL
 import PIL.Image
 import requests
 
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+
 __version__ = '1.3.0'
 
 _logger = logging.getLogger(__name__)
@@ -46,49 +59,170 @@ _defaults = dict(
     , resize_dir = 'beandregs-output/resized'
     , log_file = 'beandregs-output/images.log'
 )
+# Downloads are network-bound, so overlap them rather than waiting on each
+# one in turn.
+_download_workers = 16
+_chunk_size = 64 * 1024
+# name = location  # comment
+# Every line matches; blank and comment-only ones have neither group set.
+_location_re = re.compile(
+    r'^[^\S\n]*(?P<name>[^#=\n]*?)[^\S\n]*'
+    r'(?:=[^\S\n]*(?P<url>[^#\n]*?))?[^\S\n]*(?:#.*)?$'
+    , re.MULTILINE)
+_timeout = 30
+_log_sync_every = 32
+# Thumbnails gain little from extra encoder passes, so favour speed.
+_jpeg_save_options = dict(format = 'JPEG', optimize = False
+    , progressive = False, quality = 85, subsampling = '4:2:0')
+_save_options = {
+    '.jpg' : _jpeg_save_options
+    , '.jpeg' : _jpeg_save_options
+    , '.png' : dict(format = 'PNG', compress_level = 1)
+}
+# Formats that libvips can shrink on load (or stream) when thumbnailing.
+_vips_exts = ('.jpg', '.jpeg', '.png', '.webp', '.tif', '.tiff')
 
-def get_image_and_resize(url, width, height, basename, resize_dir = None):
+# Share one session so that images from the same host reuse keep-alive
+# connections instead of paying for a new TCP/TLS handshake each time.
+_session = requests.Session()
+for _prefix in ('http://', 'https://'):
+    _session.mount(_prefix, requests.adapters.HTTPAdapter(
+        pool_connections = 16, pool_maxsize = _download_workers))
+
+def _image_paths(url, basename):
     ext = os.path.splitext(url)[1].lower()
     resized = basename + ext
     h, t = os.path.split(basename)
-    orig = os.path.join(h, 'orig-' + t + ext)
-    if os.path.exists(orig):
-        _logger.debug(f'{orig} already exists, clobbering')
+    return os.path.join(h, 'orig-' + t + ext), resized
+
+def _read_etag(path):
+    try:
+        with open(path + '.etag', 'r', encoding = 'utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _download(url, orig, resized, width, height):
+    # A tag for a previous download that never made it through _resize is
+    # of no further use.
+    if os.path.exists(orig + '.etag'):
+        os.remove(orig + '.etag')
 
     if os.path.exists(url):
-        _logger.debug(f'Copying local file {url} to {orig}')
+        if os.path.exists(orig):
+            _logger.debug('%s already exists, clobbering', orig)
+        _logger.debug('Copying local file %s to %s', url, orig)
+        # copy2 already goes through os.sendfile() on Linux, so there's
+        # nothing to gain from doing that by hand.
         shutil.copy2(url, orig)
-    else:
-        with requests.get(url) as r:
-            if not r.ok:
-                _logger.error(
-                    f'Could not get {url}: {r.status_code} {r.reason}')
-                return
-            with open(orig, 'w+b') as f:
-                f.write(r.content)
+        return True
+
+    # Remember the ETag from the last download so that reruns only transfer
+    # images that have changed upstream.  The original doesn't outlive the
+    # resize, so the tag goes with what was made from it, and is only good
+    # for the same URL at the same size.  Then an unchanged image needs no
+    # resizing; None signals that.
+    headers = {}
+    tag = _read_etag(resized)
+    if (os.path.exists(resized) and 'etag' in tag
+            and (tag.get('url'), tag.get('width'), tag.get('height'))
+                == (url, width, height)):
+        headers['If-None-Match'] = tag['etag']
+
+    with _session.get(url, headers = headers, stream = True
+            , timeout = _timeout) as r:
+        if 304 == r.status_code:
+            _logger.debug('%s not modified; keeping %s', url, resized)
+            return None
+        if not r.ok:
+            _logger.error(
+                'Could not get %s: %s %s', url, r.status_code, r.reason)
+            return False
+        if os.path.exists(orig):
+            _logger.debug('%s already exists, clobbering', orig)
+        r.raw.decode_content = True
+        with open(orig, 'w+b') as f:
+            shutil.copyfileobj(r.raw, f, _chunk_size)
+        etag = r.headers.get('ETag')
+
+    # Park the new tag next to the original; _resize moves it over to the
+    # resized image once that has been written successfully.
+    if etag:
+        with open(orig + '.etag', 'w', encoding = 'utf-8') as f:
+            json.dump(dict(
+                url = url, width = width, height = height, etag = etag), f)
+
+    return True
+
+def _thumbnail(orig, resized, width, height):
+    ext = os.path.splitext(orig)[1]
+    if pyvips and ext in _vips_exts:
+        # Opening only reads the header; the pixels are streamed through
+        # thumbnail() a tile at a time.
+        im = pyvips.Image.new_from_file(orig)
+        if im.width <= width and im.height <= height: return False
+        _logger.debug('Resizing %s to %s with libvips', orig, resized)
+        pyvips.Image.thumbnail(orig, width, height = height
+            , size = 'down').write_to_file(resized)
+        return True
 
     with PIL.Image.open(orig) as im:
+        if ext in ('.jpg', '.jpeg'):
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale when that still
+            # leaves enough pixels for a good downsample.
+            im.draft(None, (width * 2, height * 2))
         w, h = im.size
-        resize_not_needed = w <= width and h <= height
-        if not resize_not_needed:
-            _logger.debug(f'Resizing {orig} to {resized}')
-            im.thumbnail((width, height), PIL.Image.ANTIALIAS)
-            im.save(resized)
+        if w <= width and h <= height: return False
+        _logger.debug('Resizing %s to %s', orig, resized)
+        r = min(width / w, height / h)
+        size = (max(1, round(w * r)), max(1, round(h * r)))
+        # With a reducing gap, Pillow box-averages down by a whole factor
+        # first, leaving Lanczos only a small fractional step to do.
+        im = im.resize(size, PIL.Image.LANCZOS, reducing_gap = 3.0)
+        im.save(resized, **_save_options.get(ext, {}))
+    return True
+
+def _copy_to_resize_dir(resized, resize_dir):
+    if not resize_dir: return
+    try:
+        same = os.path.samefile(
+            resized, os.path.join(resize_dir, os.path.basename(resized)))
+    except OSError:
+        same = False
+    if not same:
+        shutil.copy2(resized, resize_dir)
+        _logger.debug('Copied %s to %s', resized, resize_dir)
+
+def _resize(orig, resized, width, height, resize_dir = None):
+    # The header alone usually says whether there's any work to do, so only
+    # open the image for real when it's too big or imagesize can't tell.
+    w, h = imagesize.get(orig, exif_rotation = False)
+    if 0 <= w <= width and 0 <= h <= height:
+        resize_not_needed = True
+    else:
+        resize_not_needed = not _thumbnail(orig, resized, width, height)
 
     if resize_not_needed:
-        if os.path.exists(resized):
-            _logger.debug(f'{resized} already exists, removing')
-            os.remove(resized)
-        _logger.debug(f'Resize not needed; renaming {orig} to {resized}')
-        os.rename(orig, resized)
-
-    if resize_dir:
-        absor = os.path.realpath(resized)
-        absnr = os.path.realpath(os.path.join(
-            resize_dir, os.path.basename(resized)))
-        if absor != absnr:
-            shutil.copy2(resized, resize_dir)
-            _logger.debug(f'Copied {resized} to {resize_dir}')
+        _logger.debug('Resize not needed; renaming %s to %s', orig, resized)
+        os.replace(orig, resized)
+    else:
+        os.remove(orig)
+
+    _copy_to_resize_dir(resized, resize_dir)
+
+    # Everything made it, so the tag from the download now vouches for it.
+    if os.path.exists(orig + '.etag'):
+        os.replace(orig + '.etag', resized + '.etag')
+    elif os.path.exists(resized + '.etag'):
+        os.remove(resized + '.etag')
+
+def get_image_and_resize(url, width, height, basename, resize_dir = None):
+    orig, resized = _image_paths(url, basename)
+    ok = _download(url, orig, resized, width, height)
+    if ok:
+        _resize(orig, resized, width, height, resize_dir)
+    elif ok is None:
+        _copy_to_resize_dir(resized, resize_dir)
 
 class Cfg:
     def __init__(self):
@@ -96,16 +230,12 @@ class Cfg:
             setattr(self, k, _defaults[k])
 
     def __str__(self):
-        s = []
-        _a = s.append
-        for k in self.__dict__:
-            _a(f'{k} = {getattr(self, k)}')
-        return '\n'.join(s)
+        return '\n'.join(f'{k} = {v}' for k, v in self.__dict__.items())
 
 def load_config(cfg_file = None):
     cfg = Cfg()
     if cfg_file:
-        _logger.debug(f'Load config file: {cfg_file}')
+        _logger.debug('Load config file: %s', cfg_file)
         tmp = configparser.ConfigParser()
         tmp.read(cfg_file)
         sec = tmp['beandregs']
@@ -115,15 +245,27 @@ def load_config(cfg_file = None):
 
     return cfg
 
+def _locations(matches):
+    for m in matches:
+        name, url = m.group('name', 'url')
+        if not name and url is None: continue
+        if not name or url is None:
+            _logger.warning('Skipping malformed line: %s', m.group().strip())
+            continue
+        yield name, url
+
 def image_locations(ims):
-    with ims if isinstance(ims, io.TextIOBase) else open(
-            ims, 'r', encoding = 'utf-8') as inf:
-        for ln in inf:
-            ln = re.sub(r'#.*$', '', ln)
-            if '' == ln or ln.isspace(): continue
-            yield [ x.strip() for x in ln.split('=', 1) ]
-
-def _setup_logging(debug = False):
+    if not isinstance(ims, io.TextIOBase):
+        # Files can be scanned in one go instead of a line at a time.
+        with open(ims, 'r', encoding = 'utf-8') as inf:
+            data = inf.read()
+        yield from _locations(_location_re.finditer(data))
+        return
+
+    with ims as inf:
+        yield from _locations(map(_location_re.match, inf))
+
+def _setup_logging(debug = False, worker = False):
     L = logging.getLogger('')
     L.setLevel(logging.DEBUG)
 
@@ -142,15 +284,23 @@ def _setup_logging(debug = False):
     ch.setLevel(logging.DEBUG if debug else logging.INFO)
     ch.setFormatter(logging.Formatter('%(message)s'))
     L.addHandler(ch)
+    if worker: return
 
-    L.debug(f'** Start beandregs v{__version__} logging.')
+    L.debug('** Start beandregs v%s logging.', __version__)
+    # Pillow-SIMD tags its releases with .postN, which makes it easy to tell
+    # which imaging library actually got installed.
+    L.debug('Using PIL v%s', PIL.__version__)
     atexit.register(L.debug, '** Stop beandregs')
 
+@functools.lru_cache(maxsize = None)
+def _local_timezone(isdst):
+    offset = time.altzone if isdst else time.timezone
+    return datetime.timezone(offset = datetime.timedelta(seconds = -offset))
+
 def ISO_8601_time_stamp():
-    offset = time.altzone if time.localtime().tm_isdst else time.timezone
-    delta = datetime.timedelta(seconds = -offset)
-    now = datetime.datetime.now()
-    return now.replace(tzinfo = datetime.timezone(offset = delta)).isoformat()
+    # The offset only changes with DST, so build each timezone just once.
+    return datetime.datetime.now(
+        _local_timezone(time.localtime().tm_isdst)).isoformat()
 
 def main(args_list = None):
     arg_parser = argparse.ArgumentParser(
@@ -172,12 +322,17 @@ def main(args_list = None):
         , help = f'Width to resize to [default: {_defaults["width"]}]')
     _a('-H', '--height', type = int
         , help = f'Height to resize to [default: {_defaults["height"]}]')
+    _a('-j', '--jobs', type = int, default = os.cpu_count() or 1
+        , help = 'Number of images to resize at once'
+            ' [default: number of CPUs]')
     _a('-d', '--debug', action = 'store_true'
         , help = 'Send all logging output to console')
     _a('-s', '--show-config', action = 'store_true'
         , help = 'Just print configuration and exit')
 
     args = arg_parser.parse_args(args_list or sys.argv[1:])
+    if args.jobs < 1:
+        arg_parser.error('--jobs must be at least 1')
 
     _setup_logging(args.debug)
     cfg = load_config(args.config)
@@ -193,23 +348,117 @@ def main(args_list = None):
         print(cfg)
         sys.exit(0)
 
-    if not os.path.exists(cfg.outdir):
-        _logger.debug(f'Creating output directory: {cfg.outdir}')
-        os.makedirs(cfg.outdir, 0o755)
-
-    if not os.path.exists(cfg.resize_dir):
-        _logger.debug(f'Creating resize directory: {cfg.resize_dir}')
-        os.makedirs(cfg.resize_dir, 0o755)
-
-    with open(cfg.log_file or os.devnull, 'at', encoding = 'utf-8') as log:
-        log.write(f'# {ISO_8601_time_stamp()}\n')
-        for name, url in image_locations(args.images):
-            _logger.info(f'[*] {name} <-- {url}')
-            try:
-                get_image_and_resize(url, cfg.width, cfg.height,
-                    os.path.join(cfg.outdir, name), cfg.resize_dir)
-                log.write(f'{name} = {url}\n')
-            except:
-                _logger.exception('Exception occurred.')
+    _logger.debug('Output directory: %s', cfg.outdir)
+    os.makedirs(cfg.outdir, 0o755, exist_ok = True)
+    _logger.debug('Resize directory: %s', cfg.resize_dir)
+    os.makedirs(cfg.resize_dir, 0o755, exist_ok = True)
+
+    # Keep downloads from running too far ahead of the resizers: entries are
+    # only handed to the download threads while fewer than this many are
+    # being fetched or resized, so a slow resize stage holds back the
+    # network one.  That's decided here in the main thread so no worker
+    # ever has to wait for room.
+    in_flight_limit = _download_workers + 2 * args.jobs
+
+    def fetch(name, url):
+        _logger.info('[*] %s <-- %s', name, url)
+        orig, resized = _image_paths(url, os.path.join(cfg.outdir, name))
+        ok = _download(url, orig, resized, cfg.width, cfg.height)
+        if ok is None:
+            _copy_to_resize_dir(resized, cfg.resize_dir)
+        return orig, resized, ok
+
+    # Write each entry straight through so a crash loses at most the last
+    # few, and only pay for an fsync() every so often.  Images finish out of
+    # order, so entries are held back until everything listed before them
+    # has settled; that keeps the log in input order.
+    locations = list(image_locations(args.images))
+    settled = [None] * len(locations)
+    logged = written = 0
+    def record(log, i, ok):
+        nonlocal logged, written
+        settled[i] = ok
+        while logged < len(locations) and settled[logged] is not None:
+            if settled[logged]:
+                name, url = locations[logged]
+                log.write(f'{name} = {url}\n'.encode('utf-8'))
+                written += 1
+                if sync_log and 0 == written % _log_sync_every:
+                    os.fsync(log.fileno())
+            logged += 1
+
+    # Resizing is CPU-bound, so farm it out to a process per core while the
+    # download threads keep fetching.  The workers are spawned rather than
+    # forked since forking under running threads can inherit held locks.
+    with open(cfg.log_file or os.devnull, 'ab', buffering = 0) as log, \
+            concurrent.futures.ThreadPoolExecutor(
+                _download_workers) as fetchers, \
+            concurrent.futures.ProcessPoolExecutor(
+                args.jobs
+                , mp_context = multiprocessing.get_context('spawn')
+                , initializer = _setup_logging
+                , initargs = (args.debug, True)) as resizers:
+        # Devices such as os.devnull refuse fsync(), and don't need it.
+        sync_log = stat.S_ISREG(os.fstat(log.fileno()).st_mode)
+        log.write(f'# {ISO_8601_time_stamp()}\n'.encode('utf-8'))
+        # Entries that share a name write to the same files, so each waits
+        # for the one before it to finish; as with a serial run, the last
+        # one listed wins.
+        outputs = [
+            os.path.normpath(
+                _image_paths(url, os.path.join(cfg.outdir, name))[1])
+            for name, url in locations ]
+        owners = {}
+        parked = collections.defaultdict(collections.deque)
+        def settle(i):
+            del owners[outputs[i]]
+            if parked[outputs[i]]:
+                queued.appendleft(parked[outputs[i]].popleft())
+
+        queued = collections.deque(range(len(locations)))
+        downloads = {}
+        resizes = {}
+        try:
+            while queued or downloads or resizes:
+                while queued and (
+                        len(downloads) + len(resizes) < in_flight_limit):
+                    i = queued.popleft()
+                    if outputs[i] in owners:
+                        parked[outputs[i]].append(i)
+                        continue
+                    owners[outputs[i]] = i
+                    downloads[fetchers.submit(fetch, *locations[i])] = i
+
+                done, _ = concurrent.futures.wait(
+                    downloads.keys() | resizes.keys()
+                    , return_when = concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    try:
+                        if fut in resizes:
+                            i = resizes.pop(fut)
+                            fut.result()
+                        else:
+                            i = downloads.pop(fut)
+                            orig, resized, ok = fut.result()
+                            if ok:
+                                resizes[resizers.submit(_resize, orig
+                                    , resized, cfg.width, cfg.height
+                                    , cfg.resize_dir)] = i
+                                continue
+                        ok = True
+                    except Exception:
+                        _logger.exception('Exception occurred.')
+                        ok = False
+                    settle(i)
+                    record(log, i, ok)
+        except BaseException:
+            # Whether interrupted or unable to write the log, don't sit and
+            # work through everything that's still queued.
+            fetchers.shutdown(cancel_futures = True)
+            resizers.shutdown(cancel_futures = True)
+            raise
+
+        if sync_log:
+            os.fsync(log.fileno())
 
 if '__main__' == __name__: main()